@@ -1,4 +1,6 @@
 import dataclasses
+from typing import Optional
+
 import torch
 
 
@@ -9,12 +11,19 @@ class LLaMAConfig:
     n_heads: int
     vocab_size: int = 32000
     max_seq_length: int = 2048
-    dtype = torch.float16
     pad_token_id: int = 0
     bos_token_id: int = 1
     eos_token_id: int = 2
     use_8bit: bool = False
     gradient_checkpointing: bool = False
+    compile_layers: bool = False
+    # dtype of the KV cache during generation. None: same as dtype. torch.int8: quantized per token, which halves
+    # the memory held by the KV cache (for larger batches or longer sequences). It is dequantized for attention
+    # on every step, so it does not make decoding faster.
+    kv_cache_dtype: Optional[torch.dtype] = None
+    use_4bit: bool = False
+    # dtype of the weights and activations
+    dtype: torch.dtype = torch.float16
 
     @property
     def head_dim(self):
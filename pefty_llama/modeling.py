@@ -1,8 +1,10 @@
 # based on https://github.com/zphang/minimal-llama/blob/c37e481136f118a16f77f50cdf5e867ed5dafbf9/minimal_llama/pref/llama_simple2.py
 
 import os
+import gc
 import json
 import math
+import functools
 import dataclasses
 
 import torch
@@ -149,6 +151,8 @@ class LLaMAModel(nn.Module):
         """
         original_input_ids = input_ids
         batch_size, seq_len = input_ids.shape
+        # [batch_size], on the device. Only used in tensor ops (never read from Python), so that it does not
+        # sync with the device.
         # noinspection PyUnresolvedReferences
         num_valid_tokens = (input_ids != self.config.pad_token_id).long().sum(dim=1)
 
@@ -164,8 +168,11 @@ class LLaMAModel(nn.Module):
         total_seq_len = seq_len
 
         # 2) First encoding
-        # [batch_size=1, num_heads=1, q_len=1, kv_len=1]
-        attention_mask = create_attention_mask(input_ids=input_ids, dtype=self.config.dtype)
+        # Padding tokens are masked out as keys. They stay in the KV cache (rather than being shifted out),
+        # and stay masked out while decoding.
+        # [batch_size, num_heads=1, q_len=seq_len, kv_len=seq_len]
+        attention_mask = create_attention_mask(
+            input_ids=input_ids, dtype=self.config.dtype, pad_token_id=self.config.pad_token_id)
         # dict(
         #   hidden_states = [batch_size, dec_seq_len=decode_step+1, hidden_dim]
         #   kv_cache = list[dict(
@@ -190,25 +197,26 @@ class LLaMAModel(nn.Module):
         generated_token_ids_list.append(generated_token_ids)
         input_ids = generated_token_ids
 
-        # 2.1 shift KV cache
-        for layer_kv_cache in kv_cache:
-            for i in range(batch_size):
-                layer_kv_cache["key"] = shift_kv_cache_right(
-                    layer_kv_cache["key"], num_valid_tokens=num_valid_tokens)
-                layer_kv_cache["value"] = shift_kv_cache_right(
-                    layer_kv_cache["value"], num_valid_tokens=num_valid_tokens)
+        # 2.1 Decoding attention mask, with room for every generated token.
+        #     The last query of the first encoding sees every valid (non-padding) key.
+        # [batch_size, num_heads=1, q_len=1, kv_len=seq_len + generation_length - 1]
+        decode_attention_mask = torch.full(
+            [batch_size, 1, 1, seq_len + generation_length - 1],
+            fill_value=torch.finfo(self.config.dtype).min,
+            dtype=self.config.dtype,
+            device=input_ids.device,
+        )
+        decode_attention_mask[:, :, :, :seq_len] = attention_mask[:, :, -1:, :]
+        # [batch_size], RoPE position of the next token
+        next_rope_embed_ids = num_valid_tokens.clone()
 
         # 3) Subsequent steps
         for decode_step in range(generation_length-1):
-            num_valid_tokens += 1
             total_seq_len += 1
-            # [batch_size=1, num_heads=1, q_len=1, kv_len=1]
-            attention_mask = convert_mask_to_soft_mask(create_generation_attention_mask(
-                batch_size=batch_size,
-                seq_len=total_seq_len,
-                num_valid_tokens=num_valid_tokens,
-                device=input_ids.device,
-            ), dtype=self.config.dtype)
+            # The new token is appended to the right end of the KV cache
+            decode_attention_mask[:, :, :, total_seq_len - 1] = 0
+            # [batch_size, num_heads=1, q_len=1, kv_len=total_seq_len]
+            attention_mask = decode_attention_mask[:, :, :, :total_seq_len]
             # dict(
             #   hidden_states = [batch_size, dec_seq_len=decode_step+1, hidden_dim]
             #   kv_cache = list[dict(
@@ -216,8 +224,8 @@ class LLaMAModel(nn.Module):
             #     value = [batch_size, num_heads, kv_seq_len=decode_step+1, head_dim]
             #   )]
             # )
-            rope_embed_ids = create_rope_embed_ids(input_ids=input_ids) + num_valid_tokens
-            cos, sin = self.get_cos_sin(rope_embed_ids)
+            cos, sin = self.get_cos_sin(next_rope_embed_ids[:, None])
+            next_rope_embed_ids += 1
             model_out = self.model(
                 input_ids=input_ids,
                 attention_mask=attention_mask,
@@ -493,7 +501,8 @@ def apply_rotary_pos_emb(q, k, cos, sin):
 
 def create_attention_mask(input_ids,
                           dtype=torch.float32,
-                          return_soft_mask=True):
+                          return_soft_mask=True,
+                          pad_token_id=None):
     """Create mask for decoder attention.
 
     Decoder masks have two use-cases:
@@ -512,15 +521,18 @@ def create_attention_mask(input_ids,
     :param input_ids: [batch_size, seq_len]
     :param dtype: dtype
     :param return_soft_mask: whether to return mask or logits-mask
-    :return: float [batch_size=1, num_heads=1, q_len=seq_len, kv_len=seq_len]
+    :param pad_token_id: if given, padding tokens are also masked out as keys
+    :return: float [batch_size=1 (batch_size with pad_token_id), num_heads=1, q_len=seq_len, kv_len=seq_len]
     """
     batch_size, seq_length = input_ids.shape
-    # [seq_len]
-    seq_ids = torch.arange(seq_length, device=input_ids.device)
-    # [seq_len, seq_len]
-    causal_mask = seq_ids[None, :].repeat(seq_length, 1) <= seq_ids[:, None]
+    if pad_token_id is None and return_soft_mask:
+        # [batch_size=1, num_heads=1, seq_len, seq_len]
+        return create_casual_soft_attention_mask(seq_length, dtype=dtype, device=input_ids.device)
     # [batch_size=1, num_heads=1, seq_len, seq_len]
-    causal_mask = causal_mask[None, None, :, :]
+    causal_mask = create_casual_attention_mask(seq_length, device=input_ids.device)
+    if pad_token_id is not None:
+        # [batch_size, num_heads=1, seq_len, seq_len]
+        causal_mask = causal_mask & (input_ids != pad_token_id)[:, None, None, :]
     if return_soft_mask:
         return convert_mask_to_soft_mask(causal_mask, dtype=dtype)
     else:
@@ -559,8 +571,12 @@ class NoInitEmbedding(nn.Embedding):
         pass
 
 
+# Checking for NaNs syncs with the device on every call, so it is only done when debugging
+CHECK_NAN = os.environ.get("PEFTY_CHECK_NAN", "0") == "1"
+
+
 def check_nan(x):
-    if torch.isnan(x).any():
+    if CHECK_NAN and torch.isnan(x).any():
         import pdb
         pdb.set_trace()
 
@@ -582,70 +598,72 @@ def create_model(model_name, hf_path, use_8bit=False, device=None):
         state_keys = set(model.state_dict())
         filename_list = sorted(list(set(weight_map.values())))
         for filename in tqdm.tqdm(filename_list):
-            loaded = torch.load(os.path.join(hf_path, filename), map_location="cpu")
+            # weights_only: a restricted unpickler (the shards only hold tensors), which is safer and faster.
+            # Memory-mapped, so tensors are read from disk straight into their destination.
+            loaded = torch.load(os.path.join(hf_path, filename), map_location="cpu", mmap=True, weights_only=True)
             for k, v in loaded.items():
                 set_module_8bit_tensor_to_device(model, tensor_name=k, device=device, value=v)
-                state_keys.remove(k)
+            state_keys.difference_update(loaded)
+            # Release the shard before loading the next one
+            del loaded
+            gc.collect()
         assert not state_keys
     else:
-        # noinspection PyUnresolvedReferences
-        torch.set_default_tensor_type(torch.cuda.HalfTensor)
-        model = LLaMAModel(config=config).cuda()
-        torch.set_default_tensor_type(torch.FloatTensor)
+        # Every module gets its dtype from the config, so only the device needs to be set
+        with torch.device(device):
+            model = LLaMAModel(config=config)
         state_keys = set(model.state_dict())
         for filename in tqdm.tqdm(filename_list):
-            loaded = torch.load(os.path.join(hf_path, filename), map_location="cpu")
+            loaded = torch.load(os.path.join(hf_path, filename), map_location="cpu", mmap=True, weights_only=True)
             model.load_state_dict(loaded, strict=False)
-            for k in loaded:
-                state_keys.remove(k)
+            state_keys.difference_update(loaded)
+            del loaded
+            gc.collect()
     return model
 
 
-def shift_kv_cache_right(layer_cache, num_valid_tokens):
-    """
-    :param layer_cache: left-aligned kv cache element, [batch_size, num_heads, seq_len, dim]
-    :param num_valid_tokens: [batch_size]
-    :return:
-    """
-    batch_size = layer_cache.shape[0]
-    # noinspection PyUnresolvedReferences
-    return torch.stack([
-        torch.cat([
-            layer_cache[i, :, num_valid_tokens[i]:, :],
-            layer_cache[i, :, :num_valid_tokens[i], :],
-        ], dim=1)
-        for i in range(batch_size)
-    ], dim=0)
-
-
-def create_generation_attention_mask(batch_size, seq_len, num_valid_tokens, device):
+def create_casual_attention_mask(seq_len, device):
+    """Causal mask, built once per (seq_len, device). The returned tensor is shared, so do not modify it.
+
+    :return: [batch_size=1, num_heads=1, seq_len, seq_len]
     """
-    :param batch_size: int
-    :param seq_len: int
-    :param num_valid_tokens: [batch_size]
-    :param device:
-    :return:
+    return _create_casual_attention_mask(seq_len, _mask_cache_device_key(device))
+
+
+def create_casual_soft_attention_mask(seq_len, dtype, device):
+    """Causal mask that can be added to logits (see: convert_mask_to_soft_mask), built once per
+    (seq_len, dtype, device). The returned tensor is shared, so do not modify it.
+
+    :return: [batch_size=1, num_heads=1, seq_len, seq_len]
     """
-    # For right-aligned, based on num_valid_tokens
-    # noinspection PyTypeChecker
-    attn_mask = torch.zeros([batch_size, 1, 1, seq_len], dtype=bool)
-    for i in range(batch_size):
-        valid = num_valid_tokens[i]
-        # noinspection PyTypeChecker
-        # attn_mask[i, 0, -valid:, -valid:] = torch.tril(torch.ones([valid, valid], dtype=bool))
-        attn_mask[i, 0, 0, -valid:] = True
-    return attn_mask.to(device=device)
+    return _create_casual_soft_attention_mask(seq_len, dtype, _mask_cache_device_key(device))
 
 
-def create_casual_attention_mask(seq_len, device):
-    # noinspection PyTypeChecker
-    attn_mask = torch.tril(torch.ones([seq_len, seq_len], dtype=bool))[None, None, :, :]
-    return attn_mask.to(device=device)
+def _mask_cache_device_key(device):
+    # So that "cuda" and "cuda:0" share cache entries
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return str(device)
+
+
+# The cached masks live for the whole process (a soft mask for 2048 tokens in fp16 is 8 MB), so only
+# a few are kept. They are built outside of inference mode, so that they can also be used in training.
+@functools.lru_cache(maxsize=4)
+@torch.inference_mode(False)
+def _create_casual_attention_mask(seq_len, device):
+    seq_ids = torch.arange(seq_len, device=device)
+    return (seq_ids[:, None] >= seq_ids[None, :])[None, None, :, :]
+
+
+@functools.lru_cache(maxsize=4)
+@torch.inference_mode(False)
+def _create_casual_soft_attention_mask(seq_len, dtype, device):
+    return convert_mask_to_soft_mask(_create_casual_attention_mask(seq_len, device), dtype=dtype)
 
 
 def create_rope_embed_ids(input_ids):
     pad_token_id = 0
     max_position = 2047  # These will not actually be used, as they are masked out by the attention mask
-    x = (input_ids != pad_token_id).cumsum(-1) - 1
-    x[input_ids == pad_token_id] = max_position
-    return x
+    is_valid = input_ids != pad_token_id
+    return torch.where(is_valid, is_valid.cumsum(-1) - 1, max_position)
@@ -1,9 +1,12 @@
 # based on https://github.com/zphang/minimal-llama/blob/c37e481136f118a16f77f50cdf5e867ed5dafbf9/minimal_llama/pref/llama_simple2.py
 
 import os
+import gc
 import json
 import math
+import functools
 import dataclasses
+import concurrent.futures
 
 import torch
 import torch.nn as nn
@@ -13,6 +16,7 @@ import bitsandbytes as bnb
 import tqdm.auto as tqdm
 
 from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
 from transformers.utils.bitsandbytes import set_module_8bit_tensor_to_device
 from transformers import (
     LlamaConfig as HF_LlamaConfig,
@@ -32,6 +36,11 @@ class LLaMAModel(nn.Module):
 
         if self.peft_config.peft_mode == peft.PEFT_PREFIX:
             self.peft_prefixes = peft.SoftPrefixes(config=config, peft_config=peft_config)
+        if config.compile_layers:
+            # Fuses the compare, cumsum and where into one kernel
+            self.create_rope_embed_ids = torch.compile(create_rope_embed_ids, fullgraph=True)
+        else:
+            self.create_rope_embed_ids = create_rope_embed_ids
 
     @classmethod
     def from_pretrained(cls, model_name_or_path, use_8bit=False):
@@ -73,24 +82,27 @@ class LLaMAModel(nn.Module):
         """
         # 1) Create masks
         # decoder mask
-        # [batch_size, num_heads=1, q_len=seq_len, kv_len=seq_len]
-        attention_mask = create_attention_mask(input_ids=input_ids, dtype=self.config.dtype)
         input_ids_for_rope = input_ids
         if self.peft_config.peft_mode == peft.PEFT_PREFIX:
+            # [batch_size=1, num_heads=1, q_len=seq_len, kv_len=num_prefix_tokens + seq_len]
+            attention_mask = create_attention_mask(input_ids=input_ids, dtype=self.config.dtype)
             attention_mask = torch.cat([
-                zeros_like([1, 1, input_ids.shape[1], self.peft_config.num_prefix_tokens], tensor=attention_mask),
+                torch.zeros([1, 1, input_ids.shape[1], self.peft_config.num_prefix_tokens],
+                            dtype=attention_mask.dtype, device=attention_mask.device),
                 attention_mask,
             ], dim=3)
+        else:
+            # Plain causal attention (also over soft prompt + input), so SDPA can use is_causal
+            # instead of a materialized mask
+            attention_mask = None
 
-        if self.peft_config.peft_mode in peft.PEFT_PROMPT:
+        if self.peft_config.peft_mode == peft.PEFT_PROMPT:
             input_ids_for_rope = torch.cat([
                 torch.ones([input_ids.shape[0], self.peft_config.num_prefix_tokens],
                            dtype=input_ids.dtype, device=input_ids.device),
                 input_ids,
             ], dim=1)
-            # Easier to just remake the attention mask
-            attention_mask = create_attention_mask(input_ids=input_ids_for_rope, dtype=self.config.dtype)
-        rope_embed_ids = create_rope_embed_ids(input_ids=input_ids_for_rope)
+        rope_embed_ids = self.create_rope_embed_ids(input_ids=input_ids_for_rope)
         cos, sin = self.get_cos_sin(rope_embed_ids)
 
         if self.peft_config.peft_mode == peft.PEFT_PREFIX:
@@ -110,66 +122,105 @@ class LLaMAModel(nn.Module):
         logits = self.lm_head(model_out["hidden_states"])
         return logits
 
-    def init_kv_cache(self, input_ids):
+    def init_kv_cache(self, input_ids, max_seq_len):
         # noinspection GrazieInspection
         """Initialize KV cache for decoding.
 
-        A KV cache consists of a list of dicts (one per layer):
+        The KV cache is preallocated to hold max_seq_len tokens, so that decoding steps write
+        into it in place rather than growing it. It consists of a list of dicts (one per layer):
             dict(
-              key = [batch_size, num_heads, kv_seq_len=0, head_dim]
-              value = [batch_size, num_heads, kv_seq_len=0, head_dim]
+              key = [batch_size, num_heads, max_seq_len, head_dim]
+              value = [batch_size, num_heads, max_seq_len, head_dim]
+              length = int, number of filled positions
             )
+        With config.kv_cache_dtype=torch.int8, key and value are stored as int8, and the dicts also hold
+            key_scale = [batch_size, num_heads, max_seq_len, 1]
+            value_scale = [batch_size, num_heads, max_seq_len, 1]
+        (see: append_to_kv_cache, read_kv_cache). This saves memory, not time: the filled part is dequantized
+        for attention on every step.
+
+        For prefix tuning, the first num_prefix_tokens positions are filled with the prefixes.
 
         :param input_ids: [batch_size, dec_seq_len]
-        :return: 0-length kv_cache
+        :param max_seq_len: int
+        :return: kv_cache
         """
         kv_cache = []
         batch_size = input_ids.shape[0]
         num_heads = self.config.n_heads
         head_dim = self.config.head_dim
-        for layer in self.model.layers:
-            device = layer.input_layernorm.weight.device
-            kv_cache.append({
-                "key": torch.zeros([batch_size, num_heads, 0, head_dim]).to(device=device, dtype=self.config.dtype),
-                "value": torch.zeros([batch_size, num_heads, 0, head_dim]).to(device=device, dtype=self.config.dtype),
-            })
+        # Attention takes keys and values in config.dtype, and only int8 is dequantized to it (see: read_kv_cache)
+        assert self.config.kv_cache_dtype in (None, torch.int8), self.config.kv_cache_dtype
+        kv_cache_dtype = self.config.kv_cache_dtype or self.config.dtype
+        # Not from the projections, which may be quantized modules without a weight Parameter
+        device = self.model.embed_tokens.weight.device
+        for _ in self.model.layers:
+            layer_kv_cache = {
+                "key": torch.zeros(
+                    [batch_size, num_heads, max_seq_len, head_dim], device=device, dtype=kv_cache_dtype),
+                "value": torch.zeros(
+                    [batch_size, num_heads, max_seq_len, head_dim], device=device, dtype=kv_cache_dtype),
+                "length": 0,
+            }
+            if kv_cache_dtype == torch.int8:
+                layer_kv_cache["key_scale"] = torch.zeros(
+                    [batch_size, num_heads, max_seq_len, 1], device=device, dtype=self.config.dtype)
+                layer_kv_cache["value_scale"] = torch.zeros(
+                    [batch_size, num_heads, max_seq_len, 1], device=device, dtype=self.config.dtype)
+            kv_cache.append(layer_kv_cache)
+        if self.peft_config.peft_mode == peft.PEFT_PREFIX:
+            prefixes = self.peft_prefixes(batch_size=batch_size)
+            kv_cache = [
+                append_to_kv_cache(layer_kv_cache, key_states=layer_prefix["key"], value_states=layer_prefix["value"])
+                for layer_kv_cache, layer_prefix in zip(kv_cache, prefixes)
+            ]
         return kv_cache
 
-    def generate(self, input_ids, generation_length: 20):
-        """Generate tokens with efficient caching of KV.
+    def prefill(self, input_ids, max_decode_len):
+        """Run the first encoding for generation, and set up the state for the decoding steps.
 
-        TODO: Add stopping conditions
-        TODO: Add sampling capabilities
+        Padding tokens are masked out as keys, so input_ids can be left- or right-padded. Their
+        positions stay in the KV cache, and stay masked out in decode_attention_mask.
 
         :param input_ids: [batch_size, enc_seq_len]
-        :param generation_length: int
-        :return: [batch_size, generation_length]
+        :param max_decode_len: int, number of KV cache positions to reserve for the decoding steps
+        :return: dict(
+            generated_token_ids = [batch_size, 1], the first generated token
+            kv_cache = See: init_kv_cache. With kv_seq_len filled positions
+            kv_seq_len = int
+            decode_attention_mask = [batch_size, num_heads=1, q_len=1, kv_len=kv_seq_len + max_decode_len]
+            next_rope_embed_ids = [batch_size], RoPE position of the next token
+        )
         """
-        original_input_ids = input_ids
         batch_size, seq_len = input_ids.shape
-        # noinspection PyUnresolvedReferences
-        num_valid_tokens = (input_ids != self.config.pad_token_id).long().sum(dim=1)
+        # [batch_size, seq_len]
+        input_is_valid = input_ids != self.config.pad_token_id
+        # [batch_size], int64 (sum of a bool tensor). The per-example positions below stay on the device,
+        # and are only used in tensor ops (never read from Python), so that they do not sync with the device.
+        num_valid_tokens = input_is_valid.sum(dim=1)
+        # [batch_size]
+        last_token_pos = torch.where(
+            input_is_valid, torch.arange(seq_len, device=input_ids.device), -1,
+        ).amax(dim=1)
 
         # 1) Setup
-        if input_ids is None:
-            # [batch_size, dec_seq_len=1]
-            input_ids = torch.LongTensor(
-                [[self.config.pad_token_id]] * batch_size
-            ).to(self.lm_head.weights.device)
-        # See: init_kv_cache. list[dict]
-        if self.peft_config.peft_mode == peft.PEFT_PREFIX:
-            kv_cache = self.peft_prefixes(batch_size=input_ids.shape[0])
-            num_valid_kv_cache = num_valid_tokens + self.peft_config.num_prefix_tokens
+        if self.peft_config.peft_mode in (peft.PEFT_PREFIX, peft.PEFT_PROMPT):
+            # Prefixes/soft prompts occupy the first num_prefix_tokens positions of the KV cache
+            total_seq_len = seq_len + self.peft_config.num_prefix_tokens
         else:
-            kv_cache = self.init_kv_cache(input_ids)
-            num_valid_kv_cache = num_valid_tokens
-        generated_token_ids_list = [original_input_ids]
-        total_seq_len = seq_len
+            total_seq_len = seq_len
+        # RoPE position of the next token. Soft prompt tokens take up positions, prefixes do not.
+        if self.peft_config.peft_mode == peft.PEFT_PROMPT:
+            next_rope_embed_ids = num_valid_tokens + self.peft_config.num_prefix_tokens
+            # Soft prompts are also part of the hidden states
+            last_token_pos += self.peft_config.num_prefix_tokens
+        else:
+            next_rope_embed_ids = num_valid_tokens.clone()
+        max_seq_len = total_seq_len + max_decode_len
+        # See: init_kv_cache. list[dict]
+        kv_cache = self.init_kv_cache(input_ids, max_seq_len=max_seq_len)
 
         # 2) First encoding
-        # [batch_size=1, num_heads=1, q_len=1, kv_len=1]
-        attention_mask = create_attention_mask(input_ids=input_ids, dtype=self.config.dtype)
-        input_ids_for_rope = input_ids
         # dict(
         #   hidden_states = [batch_size, dec_seq_len=decode_step+1, hidden_dim]
         #   kv_cache = list[dict(
@@ -177,24 +228,32 @@ class LLaMAModel(nn.Module):
         #     value = [batch_size, num_heads, kv_seq_len=decode_step+1, head_dim]
         #   )]
         # )
-        if self.peft_config.peft_mode in (peft.PEFT_PREFIX, peft.PEFT_PROMPT):
-            num_prefix_tokens = self.peft_config.num_prefix_tokens
-            total_seq_len += num_prefix_tokens
-            # [batch_size, num_heads=1, q_len=seq_len, kv_len=num_prefix_tokens + dec_seq_len]
+        input_ids_for_rope = input_ids
+        pad_token_id = self.config.pad_token_id
+        if self.peft_config.peft_mode == peft.PEFT_PREFIX:
+            # [batch_size, num_heads=1, q_len=seq_len, kv_len=num_prefix_tokens + seq_len]
+            attention_mask = create_attention_mask(
+                input_ids=input_ids, dtype=self.config.dtype, pad_token_id=pad_token_id)
             attention_mask = torch.cat([
-                zeros_like([1, 1, input_ids.shape[1], num_prefix_tokens], tensor=attention_mask),
+                torch.zeros([batch_size, 1, seq_len, self.peft_config.num_prefix_tokens],
+                            dtype=attention_mask.dtype, device=attention_mask.device),
                 attention_mask,
             ], dim=3)
-
-        if self.peft_config.peft_mode in peft.PEFT_PROMPT:
+        elif self.peft_config.peft_mode == peft.PEFT_PROMPT:
             input_ids_for_rope = torch.cat([
                 torch.ones([input_ids.shape[0], self.peft_config.num_prefix_tokens],
                            dtype=input_ids.dtype, device=input_ids.device),
                 input_ids,
             ], dim=1)
-            # Easier to just remake the attention mask
-            attention_mask = create_attention_mask(input_ids=input_ids_for_rope, dtype=self.config.dtype)
-        rope_embed_ids = create_rope_embed_ids(input_ids=input_ids_for_rope)
+            # Soft prompt tokens are part of the sequence, so the mask is causal over the full length
+            # [batch_size, num_heads=1, q_len=num_prefix_tokens + seq_len, kv_len=num_prefix_tokens + seq_len]
+            attention_mask = create_attention_mask(
+                input_ids=input_ids_for_rope, dtype=self.config.dtype, pad_token_id=pad_token_id)
+        else:
+            # [batch_size, num_heads=1, q_len=seq_len, kv_len=seq_len]
+            attention_mask = create_attention_mask(
+                input_ids=input_ids, dtype=self.config.dtype, pad_token_id=pad_token_id)
+        rope_embed_ids = self.create_rope_embed_ids(input_ids=input_ids_for_rope)
         cos, sin = self.get_cos_sin(rope_embed_ids)
         model_out = self.model(
             input_ids=input_ids,
@@ -202,34 +261,93 @@ class LLaMAModel(nn.Module):
             cos=cos, sin=sin,
             kv_cache=kv_cache,
         )
-        logits = self.lm_head(model_out["hidden_states"])
         kv_cache = model_out["kv_cache"]
-        generated_token_ids = logits.argmax(-1)[
-            torch.arange(batch_size, dtype=torch.long, device=input_ids.device),
-            num_valid_tokens-1,
-        ][:, None]
-        generated_token_ids_list.append(generated_token_ids)
-        input_ids = generated_token_ids
-
-        # 2.1 shift KV cache
-        for layer_kv_cache in kv_cache:
-            for i in range(batch_size):
-                layer_kv_cache["key"] = shift_kv_cache_right(
-                    layer_kv_cache["key"], num_valid_tokens=num_valid_kv_cache)
-                layer_kv_cache["value"] = shift_kv_cache_right(
-                    layer_kv_cache["value"], num_valid_tokens=num_valid_kv_cache)
+        # Only the last valid token of each row is needed, so pick its hidden state before lm_head
+        hidden_dim = model_out["hidden_states"].shape[-1]
+        # [batch_size, 1, hidden_dim]
+        last_hidden_states = model_out["hidden_states"].gather(
+            1, last_token_pos[:, None, None].expand(-1, 1, hidden_dim),
+        )
+        # [batch_size, 1]
+        generated_token_ids = self.lm_head(last_hidden_states).argmax(-1)
+
+        # 2.1 Preallocate the decoding attention mask, with room for every generated token.
+        #     Only the columns of newly generated tokens change between steps.
+        # [batch_size, num_heads=1, q_len=1, kv_len=max_seq_len]
+        decode_attention_mask = torch.full(
+            [batch_size, 1, 1, max_seq_len],
+            fill_value=torch.finfo(self.config.dtype).min,
+            dtype=self.config.dtype,
+            device=input_ids.device,
+        )
+        # The last query of the first encoding sees every valid (non-padding) key
+        decode_attention_mask[:, :, :, :total_seq_len] = attention_mask[:, :, -1:, :]
+
+        return {
+            "generated_token_ids": generated_token_ids,
+            "kv_cache": kv_cache,
+            "kv_seq_len": total_seq_len,
+            "decode_attention_mask": decode_attention_mask,
+            "next_rope_embed_ids": next_rope_embed_ids,
+        }
+
+    def generate(self, input_ids, generation_length: 20):
+        """Generate tokens with efficient caching of KV.
+
+        TODO: Add stopping conditions
+        TODO: Add sampling capabilities
+
+        :param input_ids: [batch_size, enc_seq_len]
+        :param generation_length: int
+        :return: [batch_size, enc_seq_len + generation_length]
+        """
+        batch_size, seq_len = input_ids.shape
+
+        # 1-2) Setup and first encoding
+        prefill_out = self.prefill(input_ids, max_decode_len=generation_length - 1)
+        kv_cache = prefill_out["kv_cache"]
+        total_seq_len = prefill_out["kv_seq_len"]
+        decode_attention_mask = prefill_out["decode_attention_mask"]
+        next_rope_embed_ids = prefill_out["next_rope_embed_ids"]
+        # Output, with the input followed by the generated tokens
+        # [batch_size, enc_seq_len + generation_length]
+        output_ids = torch.empty(
+            [batch_size, seq_len + generation_length], dtype=torch.long, device=input_ids.device,
+        )
+        output_ids[:, :seq_len] = input_ids
+        # [batch_size, generation_length]
+        generated_token_ids = output_ids[:, seq_len:]
+        generated_token_ids[:, :1] = prefill_out["generated_token_ids"]
+        # With compiled layers, every step attends over the whole preallocated KV cache (with the unfilled
+        # positions masked out), and writes to it at a position tensor, so that every step has the same
+        # shapes and Python values, and replays the same CUDA graph.
+        static_shapes = self.config.compile_layers
+        if static_shapes:
+            # [1]
+            write_position = torch.full([1], total_seq_len, dtype=torch.long, device=input_ids.device)
+            kv_cache = [
+                {**{k: v for k, v in layer_kv_cache.items() if k != "length"}, "position": write_position}
+                for layer_kv_cache in kv_cache
+            ]
+            # The compiled layers write into the KV cache buffers. mode="reduce-overhead" only uses CUDA graphs
+            # when the inputs that are mutated have static addresses, and otherwise skips them.
+            for layer_kv_cache in kv_cache:
+                for k in ("key", "value", "key_scale", "value_scale"):
+                    if k in layer_kv_cache:
+                        torch._dynamo.mark_static_address(layer_kv_cache[k])
 
         # 3) Subsequent steps
         for decode_step in range(generation_length-1):
-            num_valid_tokens += 1
-            total_seq_len += 1
-            # [batch_size=1, num_heads=1, q_len=1, kv_len=1]
-            attention_mask = convert_mask_to_soft_mask(create_generation_attention_mask(
-                batch_size=batch_size,
-                seq_len=total_seq_len,
-                num_valid_tokens=num_valid_tokens,
-                device=input_ids.device,
-            ), dtype=self.config.dtype)
+            if static_shapes:
+                decode_attention_mask.index_fill_(3, write_position, 0)
+                # [batch_size, num_heads=1, q_len=1, kv_len=max_seq_len]
+                attention_mask = decode_attention_mask
+            else:
+                total_seq_len += 1
+                # The new token is appended to the right end of the KV cache
+                decode_attention_mask[:, :, :, total_seq_len - 1] = 0
+                # [batch_size, num_heads=1, q_len=1, kv_len=total_seq_len]
+                attention_mask = decode_attention_mask[:, :, :, :total_seq_len]
             # dict(
             #   hidden_states = [batch_size, dec_seq_len=decode_step+1, hidden_dim]
             #   kv_cache = list[dict(
@@ -237,35 +355,163 @@ class LLaMAModel(nn.Module):
             #     value = [batch_size, num_heads, kv_seq_len=decode_step+1, head_dim]
             #   )]
             # )
-            rope_embed_ids = create_rope_embed_ids(input_ids=input_ids) + num_valid_tokens
-            cos, sin = self.get_cos_sin(rope_embed_ids)
+            # [batch_size, num_heads=1, q_len=1, head_dim]
+            cos, sin = self.get_cos_sin_slice(next_rope_embed_ids)
+            next_rope_embed_ids += 1
+            model_out = self.model(
+                input_ids=generated_token_ids[:, decode_step:decode_step + 1],
+                attention_mask=attention_mask,
+                kv_cache=kv_cache,
+                cos=cos, sin=sin,
+            )
+            # [batch_size, vocab_size]
+            logits = self.lm_head(model_out["hidden_states"][:, -1])
+            kv_cache = model_out["kv_cache"]
+            generated_token_ids[:, decode_step + 1] = logits.argmax(-1)
+            if static_shapes:
+                write_position += 1
+        return output_ids
+
+    def generate_chunked(self, input_ids, generation_length: int = 20, chunk_size: int = 4):
+        """Greedy generation that decodes chunk_size tokens per forward pass.
+
+        Decoding is bound by loading the weights once per forward pass, so each step feeds the last
+        generated token followed by chunk_size - 1 draft tokens. Drafts are copied from after the most
+        recent earlier occurrence of the last generated token (prompt lookup). Leading drafts that agree
+        with the model's own greedy predictions are accepted, so the output matches generate(), but every
+        step yields between 1 and chunk_size tokens.
+
+        :param input_ids: [batch_size, enc_seq_len]
+        :param generation_length: int
+        :param chunk_size: int, number of tokens decoded per step
+        :return: [batch_size, enc_seq_len + generation_length]
+        """
+        assert chunk_size >= 1, chunk_size
+        original_input_ids = input_ids
+        batch_size, seq_len = input_ids.shape
+        device = input_ids.device
+
+        # 1-2) Setup and first encoding
+        # Every step writes chunk_size positions to the KV cache, including the rejected ones
+        prefill_out = self.prefill(input_ids, max_decode_len=(generation_length - 1) * chunk_size)
+        kv_cache = prefill_out["kv_cache"]
+        total_seq_len = prefill_out["kv_seq_len"]
+        decode_attention_mask = prefill_out["decode_attention_mask"]
+        next_rope_embed_ids = prefill_out["next_rope_embed_ids"]
+
+        # Input followed by generated tokens, to look up drafts from. The generated part has room for
+        # the predictions of a last step that go past generation_length.
+        # [batch_size, history_len=seq_len + generation_length + chunk_size]
+        history_ids = torch.zeros([batch_size, seq_len + generation_length + chunk_size],
+                                  dtype=torch.long, device=device)
+        history_ids[:, :seq_len] = original_input_ids
+        # [batch_size, generation_length + chunk_size]
+        generated_token_ids = history_ids[:, seq_len:]
+        generated_token_ids[:, :1] = prefill_out["generated_token_ids"]
+        # [batch_size]
+        num_generated = torch.ones([batch_size], dtype=torch.long, device=device)
+        # [batch_size, num_heads=1, q_len=chunk_size, kv_len=chunk_size]
+        chunk_attention_mask = create_casual_soft_attention_mask(
+            seq_len=chunk_size, dtype=self.config.dtype, device=device,
+        )
+        chunk_ids = torch.arange(chunk_size, device=device)
+        history_pos = torch.arange(history_ids.shape[1], device=device)
+        generated_pos = history_pos[:generated_token_ids.shape[1]]
+        input_is_valid = original_input_ids != self.config.pad_token_id
+
+        # 3) Subsequent steps (checking the stopping condition syncs with the device once per step)
+        while num_generated.min() < generation_length:
+            # [batch_size]
+            last_token_ids = generated_token_ids.gather(1, (num_generated - 1)[:, None])[:, 0]
+            last_token_pos = seq_len + num_generated - 1
+
+            # 3.1) Drafts. Without an earlier occurrence, the drafts are arbitrary and will be rejected.
+            # [batch_size, history_len]
+            history_is_valid = torch.cat([
+                input_is_valid, generated_pos[None, :] < num_generated[:, None],
+            ], dim=1)
+            is_occurrence = (history_ids == last_token_ids[:, None]) & history_is_valid \
+                & (history_pos[None, :] < last_token_pos[:, None])
+            # [batch_size]
+            occurrence_pos = torch.where(is_occurrence, history_pos[None, :], -1).amax(dim=1)
+            # [batch_size, chunk_size - 1]
+            draft_pos = (occurrence_pos[:, None] + 1 + chunk_ids[None, :-1]).clamp(0, history_ids.shape[1] - 1)
+            # [batch_size, chunk_size]
+            step_input_ids = torch.cat([last_token_ids[:, None], history_ids.gather(1, draft_pos)], dim=1)
+
+            # 3.2) Forward pass over the chunk: attend to the valid KV cache, and causally within the chunk
+            # [batch_size, num_heads=1, q_len=chunk_size, kv_len=total_seq_len + chunk_size]
+            attention_mask = torch.cat([
+                decode_attention_mask[:, :, :, :total_seq_len].expand(-1, -1, chunk_size, -1),
+                chunk_attention_mask.expand(batch_size, -1, -1, -1),
+            ], dim=3)
+            # [batch_size, num_heads=1, q_len=chunk_size, head_dim]
+            cos, sin = self.get_cos_sin_slice(next_rope_embed_ids, length=chunk_size)
             model_out = self.model(
-                input_ids=input_ids,
+                input_ids=step_input_ids,
                 attention_mask=attention_mask,
                 kv_cache=kv_cache,
                 cos=cos, sin=sin,
             )
-            # [batch_size, dec_seq_len=1, vocab_size]
-            logits = self.lm_head(model_out["hidden_states"])
             kv_cache = model_out["kv_cache"]
-            # [batch_size, dec_seq_len=1]
-            generated_token_ids = logits.argmax(-1)[:, -1:]
-            generated_token_ids_list.append(generated_token_ids)
-            input_ids = generated_token_ids
-        return torch.cat(generated_token_ids_list, dim=1)
+            # [batch_size, chunk_size]
+            predicted_token_ids = self.lm_head(model_out["hidden_states"]).argmax(-1)
+
+            # 3.3) Accept drafts up to the first one that disagrees with the prediction before it
+            # [batch_size]
+            num_accepted = 1 + (step_input_ids[:, 1:] == predicted_token_ids[:, :-1]).long().cumprod(dim=1).sum(dim=1)
+            # KV of the accepted chunk tokens is kept; that of the rejected ones stays masked out
+            decode_attention_mask[:, 0, 0, total_seq_len:total_seq_len + chunk_size].masked_fill_(
+                chunk_ids[None, :] < num_accepted[:, None], 0)
+            # Predictions past the accepted ones are overwritten by the next step
+            generated_token_ids.scatter_(1, num_generated[:, None] + chunk_ids[None, :], predicted_token_ids)
+            num_generated = (num_generated + num_accepted).clamp(max=generation_length)
+            next_rope_embed_ids += num_accepted
+            total_seq_len += chunk_size
+        return history_ids[:, :seq_len + generation_length]
 
     def get_cos_sin(self, rope_embed_ids):
-        cos = F.embedding(
-            rope_embed_ids,
-            self.model.layers[0].self_attn.rotary_emb.cos_cached[0, 0]
-        ).to(self.config.dtype)
-        sin = F.embedding(
-            rope_embed_ids,
-            self.model.layers[0].self_attn.rotary_emb.sin_cached[0, 0]
-        ).to(self.config.dtype)
+        """Look up RoPE cos/sin for arbitrary positions (e.g. with padding).
+
+        :param rope_embed_ids: [batch_size, seq_len]
+        :return: cos, sin [batch_size, num_heads=1, seq_len, head_dim]
+        """
+        rotary_emb = self.model.layers[0].self_attn.rotary_emb
+        cos = F.embedding(rope_embed_ids, rotary_emb.cos_cached[0, 0])
+        sin = F.embedding(rope_embed_ids, rotary_emb.sin_cached[0, 0])
         cos, sin = cos[:, None, :, :], sin[:, None, :, :]
         return cos, sin
 
+    def get_cos_sin_slice(self, pos, length=1):
+        """Get RoPE cos/sin for the contiguous positions [pos, pos + length).
+
+        :param pos: int, or [batch_size] start position for each batch element
+        :param length: int
+        :return: cos, sin [batch_size (or 1 if pos is an int), num_heads=1, length, head_dim]
+        """
+        rotary_emb = self.model.layers[0].self_attn.rotary_emb
+        if isinstance(pos, int):
+            return rotary_emb.cos_cached[:, :, pos:pos + length], rotary_emb.sin_cached[:, :, pos:pos + length]
+        # [batch_size, length]
+        position_ids = pos[:, None] + torch.arange(length, device=pos.device)
+        cos = rotary_emb.cos_cached[0, 0][position_ids]
+        sin = rotary_emb.sin_cached[0, 0][position_ids]
+        return cos[:, None, :, :], sin[:, None, :, :]
+
+    @torch.no_grad()
+    def fold_norm_weights(self):
+        """Fold each RMSNorm weight into the projection that follows it. For inference only.
+
+        (x * weight) @ W.T == x @ (W * weight).T, so the norms no longer scale their outputs.
+        The folded model no longer matches the checkpoint, so it should not be trained or saved.
+        """
+        assert not self.config.use_8bit and not self.config.use_4bit, "Quantized weights cannot be rescaled in place"
+        for layer in self.model.layers:
+            layer.fold_norm_weights()
+        if self.model.norm.weight is not None:
+            self.lm_head.weight.mul_(self.model.norm.weight[None, :])
+            self.model.norm.weight = None
+
     def gradient_checkpointing_enable(self):
         self.config.gradient_checkpointing = True
 
@@ -286,11 +532,21 @@ class LLaMAInnerModel(nn.Module):
             LLaMALayer(config=config, peft_config=peft_config)
             for _ in range(config.n_layers)
         ])
-        self.norm = RMSNorm(dim=config.dim)
+        if config.compile_layers:
+            # Compile the forward of each layer (rather than wrapping the layer modules),
+            # so that parameter names, and thus checkpoint loading, are unaffected
+            for layer in self.layers:
+                layer._forward_impl = torch.compile(layer._forward_impl, mode="reduce-overhead")
+        self.norm = RMSNorm(dim=config.dim, dtype=config.dtype)
 
         if self.peft_config.peft_mode == peft.PEFT_PROMPT:
             self.peft_prompt = peft.AddSoftPrompt(config=config, peft_config=peft_config)
 
+        if self.peft_config.peft_mode == peft.PEFT_PROMPT:
+            self._embed_impl = LLaMAInnerModel._embed_with_soft_prompt
+        else:
+            self._embed_impl = LLaMAInnerModel._embed_tokens
+
     def forward(self,
                 input_ids,
                 attention_mask,
@@ -298,16 +554,12 @@ class LLaMAInnerModel(nn.Module):
                 kv_cache=None):
         """
         :param input_ids: [batch_size, seq_len]
-        :param attention_mask: [batch_size=1, num_heads=1, seq_len, seq_len]
+        :param attention_mask: [batch_size=1, num_heads=1, seq_len, seq_len], or None for causal attention
         :param kv_cache: See init_kv_cache.
         :param cos: for RoPE
         :param sin: for RoPE
         """
-        hidden_states = self.embed_tokens(input_ids)
-        if self.peft_config.peft_mode == peft.PEFT_PROMPT:
-            if kv_cache is None or kv_cache[0]["key"].shape[2] == 0:
-                # Only add prompt if kv_cache is None (full forward pass) or if kv_cache is empty (first decode step)
-                hidden_states = self.peft_prompt(hidden_states)
+        hidden_states = self._embed_impl(self, input_ids, kv_cache=kv_cache)
 
         new_kv_cache = []
         for layer_i, layer in enumerate(self.layers):
@@ -347,8 +599,25 @@ class LLaMAInnerModel(nn.Module):
             output["kv_cache"] = new_kv_cache
         return output
 
+    def _embed_tokens(self, input_ids, kv_cache):
+        return self.embed_tokens(input_ids)
+
+    def _embed_with_soft_prompt(self, input_ids, kv_cache):
+        hidden_states = self.embed_tokens(input_ids)
+        if kv_cache is None or kv_cache[0].get("length") == 0:
+            # Only add prompt if kv_cache is None (full forward pass) or if kv_cache is empty (first decode step)
+            hidden_states = self.peft_prompt(hidden_states)
+        return hidden_states
+
 
 class LLaMALayer(nn.Module):
+    """Decoder layer.
+
+    The forward for the PEFT mode is picked once in __init__ (as in Attention and MLP, and for the embedding in
+    LLaMAInnerModel), rather than checking the mode in every forward, so that the (compiled) layers have no
+    PEFT branches. It is stored as a plain function, and called with self: a bound method would still be bound
+    to the original module in the replicas made by nn.DataParallel (which copy __dict__).
+    """
     def __init__(self, config: LLaMAConfig, peft_config: peft.PeftConfig):
         super().__init__()
         self.config = config
@@ -367,7 +636,33 @@ class LLaMALayer(nn.Module):
             self.peft_input_layernorm_bias = peft.BitFitAddBias(dim=config.dim, dtype=config.dtype)
             self.peft_post_attention_layernorm_bias = peft.BitFitAddBias(dim=config.dim, dtype=config.dtype)
 
-    def forward(
+        if self.peft_config.peft_mode == peft.PEFT_ADAPTER:
+            if self.peft_config.adapter_version == peft.ADAPTER_VERSION_HOULSBY:
+                self._forward_impl = LLaMALayer._forward_houlsby_adapter
+            else:
+                self._forward_impl = LLaMALayer._forward_adapter
+        elif self.peft_config.peft_mode == peft.PEFT_BITFIT:
+            self._forward_impl = LLaMALayer._forward_bitfit
+        else:
+            self._forward_impl = LLaMALayer._forward_base
+
+    def forward(self, hidden_states, attention_mask, cos, sin, kv_cache=None):
+        return self._forward_impl(
+            self, hidden_states=hidden_states, attention_mask=attention_mask, cos=cos, sin=sin, kv_cache=kv_cache)
+
+    @torch.no_grad()
+    def fold_norm_weights(self):
+        """See: LLaMAModel.fold_norm_weights. Does nothing if already folded."""
+        # BitFit adds a bias to the norm outputs, which would then be scaled as well
+        assert self.peft_config.peft_mode != peft.PEFT_BITFIT, "Cannot fold norm weights with BitFit"
+        if self.input_layernorm.weight is None:
+            return
+        self.self_attn.qkv_proj.weight.mul_(self.input_layernorm.weight[None, :])
+        self.input_layernorm.weight = None
+        self.mlp.gate_up_proj.weight.mul_(self.post_attention_layernorm.weight[None, :])
+        self.post_attention_layernorm.weight = None
+
+    def _forward_base(
         self,
         hidden_states,
         attention_mask,
@@ -377,8 +672,6 @@ class LLaMALayer(nn.Module):
         # 1) Self-attention
         # [batch_size, seq_len, hidden_dim]
         normed_hidden_states = self.input_layernorm(hidden_states)
-        if self.peft_config.peft_mode == peft.PEFT_BITFIT:
-            normed_hidden_states = self.peft_input_layernorm_bias(normed_hidden_states)
         # dict(
         #   attn_output = [batch_size, seq_len, hidden_dim]
         #   kv_cache = dict(
@@ -394,26 +687,85 @@ class LLaMALayer(nn.Module):
             cos=cos, sin=sin,
         )
         # [batch_size, seq_len, hidden_dim]
-        attn_out = raw_self_attn_output["attn_output"]
-        if self.peft_config.peft_mode == peft.PEFT_ADAPTER \
-                and self.peft_config.adapter_version == peft.ADAPTER_VERSION_HOULSBY:
-            attn_out = self.peft_adapter_attn(attn_out)
-
-        # [batch_size, seq_len, hidden_dim]
-        hidden_states = hidden_states + attn_out
+        hidden_states = hidden_states + raw_self_attn_output["attn_output"]
         check_nan(hidden_states)
         # 2) FFN
         # [batch_size, seq_len, hidden_dim]
-        post_normed_hidden_states = self.post_attention_layernorm(hidden_states)
-        if self.peft_config.peft_mode == peft.PEFT_BITFIT:
-            post_normed_hidden_states = self.peft_post_attention_layernorm_bias(post_normed_hidden_states)
+        hidden_states = hidden_states + self.mlp(self.post_attention_layernorm(hidden_states))
+        check_nan(hidden_states)
+        return self._make_output(hidden_states, raw_self_attn_output=raw_self_attn_output, kv_cache=kv_cache)
 
-        mlp_out = self.mlp(post_normed_hidden_states)
-        if self.peft_config.peft_mode == peft.PEFT_ADAPTER:
-            mlp_out = self.peft_adapter_mlp(mlp_out)
+    def _forward_adapter(
+        self,
+        hidden_states,
+        attention_mask,
+        cos, sin,
+        kv_cache=None,
+    ):
+        # Pfeiffer adapter: after the FFN only
+        normed_hidden_states = self.input_layernorm(hidden_states)
+        check_nan(normed_hidden_states)
+        raw_self_attn_output = self.self_attn(
+            hidden_states=normed_hidden_states,
+            attention_mask=attention_mask,
+            kv_cache=kv_cache,
+            cos=cos, sin=sin,
+        )
+        hidden_states = hidden_states + raw_self_attn_output["attn_output"]
+        check_nan(hidden_states)
+        mlp_out = self.mlp(self.post_attention_layernorm(hidden_states))
+        hidden_states = hidden_states + self.peft_adapter_mlp(mlp_out)
+        check_nan(hidden_states)
+        return self._make_output(hidden_states, raw_self_attn_output=raw_self_attn_output, kv_cache=kv_cache)
+
+    def _forward_houlsby_adapter(
+        self,
+        hidden_states,
+        attention_mask,
+        cos, sin,
+        kv_cache=None,
+    ):
+        # Houlsby adapter: after both self-attention and the FFN
+        normed_hidden_states = self.input_layernorm(hidden_states)
+        check_nan(normed_hidden_states)
+        raw_self_attn_output = self.self_attn(
+            hidden_states=normed_hidden_states,
+            attention_mask=attention_mask,
+            kv_cache=kv_cache,
+            cos=cos, sin=sin,
+        )
+        hidden_states = hidden_states + self.peft_adapter_attn(raw_self_attn_output["attn_output"])
+        check_nan(hidden_states)
+        mlp_out = self.mlp(self.post_attention_layernorm(hidden_states))
+        hidden_states = hidden_states + self.peft_adapter_mlp(mlp_out)
+        check_nan(hidden_states)
+        return self._make_output(hidden_states, raw_self_attn_output=raw_self_attn_output, kv_cache=kv_cache)
 
-        hidden_states = hidden_states + mlp_out
+    def _forward_bitfit(
+        self,
+        hidden_states,
+        attention_mask,
+        cos, sin,
+        kv_cache=None,
+    ):
+        normed_hidden_states = self.peft_input_layernorm_bias(self.input_layernorm(hidden_states))
+        check_nan(normed_hidden_states)
+        raw_self_attn_output = self.self_attn(
+            hidden_states=normed_hidden_states,
+            attention_mask=attention_mask,
+            kv_cache=kv_cache,
+            cos=cos, sin=sin,
+        )
+        hidden_states = hidden_states + raw_self_attn_output["attn_output"]
+        check_nan(hidden_states)
+        post_normed_hidden_states = self.peft_post_attention_layernorm_bias(
+            self.post_attention_layernorm(hidden_states))
+        hidden_states = hidden_states + self.mlp(post_normed_hidden_states)
         check_nan(hidden_states)
+        return self._make_output(hidden_states, raw_self_attn_output=raw_self_attn_output, kv_cache=kv_cache)
+
+    @staticmethod
+    def _make_output(hidden_states, raw_self_attn_output, kv_cache):
         if kv_cache:
             return {
                 "hidden_states": hidden_states,
@@ -438,14 +790,8 @@ class MLP(nn.Module):
         hidden_dim = int(2 * hidden_dim / 3)
         hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
 
-        if config.use_8bit:
-            self.gate_proj = NoInit8bitLinear(dim, hidden_dim, bias=False, threshold=6.0, has_fp16_weights=False)
-            self.up_proj = NoInit8bitLinear(dim, hidden_dim, bias=False, threshold=6.0, has_fp16_weights=False)
-            self.down_proj = NoInit8bitLinear(hidden_dim, dim, bias=False, threshold=6.0, has_fp16_weights=False)
-        else:
-            self.gate_proj = NoInitLinear(dim, hidden_dim, bias=False, dtype=config.dtype)
-            self.up_proj = NoInitLinear(dim, hidden_dim, bias=False, dtype=config.dtype)
-            self.down_proj = NoInitLinear(hidden_dim, dim, bias=False, dtype=config.dtype)
+        self.gate_up_proj = create_linear(config, dim, 2 * hidden_dim)
+        self.down_proj = create_linear(config, hidden_dim, dim)
 
         if self.peft_config.peft_mode == peft.PEFT_IA3:
             self.peft_ia3 = peft.IA3ForMLP(config)
@@ -454,22 +800,30 @@ class MLP(nn.Module):
             self.peft_up_proj_bias = peft.BitFitAddBias(dim=hidden_dim, dtype=config.dtype)
             self.peft_down_proj_bias = peft.BitFitAddBias(dim=dim, dtype=config.dtype)
 
+        if self.peft_config.peft_mode == peft.PEFT_IA3:
+            self._forward_impl = MLP._forward_ia3
+        elif self.peft_config.peft_mode == peft.PEFT_BITFIT:
+            self._forward_impl = MLP._forward_bitfit
+        else:
+            self._forward_impl = MLP._forward_base
+
     def forward(self, x):
-        gate_proj = self.gate_proj(x)
-        up_proj = self.up_proj(x)
-        if self.peft_config.peft_mode == peft.PEFT_BITFIT:
-            gate_proj = self.peft_gate_proj_bias(gate_proj)
-            up_proj = self.peft_gate_proj_bias(up_proj)
+        return self._forward_impl(self, x)
 
-        intermediate_state = F.silu(gate_proj * up_proj)
-        if self.peft_config.peft_mode == peft.PEFT_IA3:
-            intermediate_state = self.peft_ia3(intermediate_state)
+    def _forward_base(self, x):
+        # gate_proj and up_proj are fused into a single matmul
+        gate_proj, up_proj = self.gate_up_proj(x).chunk(2, dim=-1)
+        return self.down_proj(F.silu(gate_proj) * up_proj)
 
-        down_proj = self.down_proj(intermediate_state)
-        if self.peft_config.peft_mode == peft.PEFT_BITFIT:
-            down_proj = self.peft_down_proj_bias(down_proj)
+    def _forward_ia3(self, x):
+        gate_proj, up_proj = self.gate_up_proj(x).chunk(2, dim=-1)
+        return self.down_proj(self.peft_ia3(F.silu(gate_proj) * up_proj))
 
-        return down_proj
+    def _forward_bitfit(self, x):
+        gate_proj, up_proj = self.gate_up_proj(x).chunk(2, dim=-1)
+        gate_proj = self.peft_gate_proj_bias(gate_proj)
+        up_proj = self.peft_up_proj_bias(up_proj)
+        return self.peft_down_proj_bias(self.down_proj(F.silu(gate_proj) * up_proj))
 
 
 class RMSNorm(torch.nn.Module):
@@ -479,11 +833,16 @@ class RMSNorm(torch.nn.Module):
         self.weight = nn.Parameter(torch.ones(dim, dtype=dtype))
 
     def _norm(self, x):
-        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
+        # Only the reduction accumulates in fp32; x itself stays in its own dtype.
+        # (vector_norm squares in fp32 as well, so large fp16 activations do not overflow.)
+        mean_square = torch.linalg.vector_norm(x, dim=-1, keepdim=True, dtype=torch.float32).pow(2) / x.shape[-1]
+        return x * torch.rsqrt(mean_square + self.eps).to(x.dtype)
 
     def forward(self, x):
-        output = self._norm(x.float()).type_as(x)
-        return output * self.weight
+        if self.weight is None:
+            # Folded into the following projection, see: LLaMAModel.fold_norm_weights
+            return self._norm(x)
+        return self._norm(x) * self.weight
 
 
 class Attention(nn.Module):
@@ -494,17 +853,9 @@ class Attention(nn.Module):
         self.n_heads = config.n_heads
         self.head_dim = config.dim // config.n_heads
 
-        if config.use_8bit:
-            self.q_proj = NoInit8bitLinear(config.dim, config.dim, bias=False, threshold=6.0, has_fp16_weights=False)
-            self.k_proj = NoInit8bitLinear(config.dim, config.dim, bias=False, threshold=6.0, has_fp16_weights=False)
-            self.v_proj = NoInit8bitLinear(config.dim, config.dim, bias=False, threshold=6.0, has_fp16_weights=False)
-            self.o_proj = NoInit8bitLinear(config.dim, config.dim, bias=False, threshold=6.0, has_fp16_weights=False)
-        else:
-            self.q_proj = NoInitLinear(config.dim, config.dim, bias=False, dtype=config.dtype)
-            self.k_proj = NoInitLinear(config.dim, config.dim, bias=False, dtype=config.dtype)
-            self.v_proj = NoInitLinear(config.dim, config.dim, bias=False, dtype=config.dtype)
-            self.o_proj = NoInitLinear(config.dim, config.dim, bias=False, dtype=config.dtype)
-        self.rotary_emb = RotaryEmbedding(dim=self.head_dim)
+        self.qkv_proj = create_linear(config, config.dim, 3 * config.dim)
+        self.o_proj = create_linear(config, config.dim, config.dim)
+        self.rotary_emb = RotaryEmbedding(dim=self.head_dim, dtype=config.dtype)
 
         if self.peft_config.peft_mode == peft.PEFT_LORA:
             self.peft_q_proj_lora = peft.LoRA(config=config, peft_config=peft_config)
@@ -519,28 +870,82 @@ class Attention(nn.Module):
         if self.peft_config.peft_mode == peft.PEFT_PREFIX_ADAPTER:
             self.peft_prefix_adapter = peft.PrefixAdapter(config=config, peft_config=peft_config)
 
+        if self.peft_config.peft_mode == peft.PEFT_LORA:
+            self._forward_impl = Attention._forward_lora
+        elif self.peft_config.peft_mode == peft.PEFT_IA3:
+            self._forward_impl = Attention._forward_ia3
+        elif self.peft_config.peft_mode == peft.PEFT_BITFIT:
+            self._forward_impl = Attention._forward_bitfit
+        elif self.peft_config.peft_mode == peft.PEFT_PREFIX_ADAPTER:
+            self._forward_impl = Attention._forward_prefix_adapter
+        else:
+            self._forward_impl = Attention._forward_base
+
     def forward(self, hidden_states, attention_mask, cos, sin, kv_cache=None):
+        return self._forward_impl(
+            self, hidden_states=hidden_states, attention_mask=attention_mask, cos=cos, sin=sin, kv_cache=kv_cache)
+
+    def _forward_base(self, hidden_states, attention_mask, cos, sin, kv_cache=None):
         """
         precomputed_kv_hidden_states is for init (pre-compute KV activations, e.g. for added prefixes)
         kv_cache is for generation (cached past KV)
+        attention_mask=None applies plain causal attention
         """
-        batch_size, q_seq_len, hidden_dim = hidden_states.size()
-
-        # (batch_size, num_heads, q_seq_len, head_dim)
-        query_states = self.q_proj(hidden_states)
-        key_states = self.k_proj(hidden_states)
-        value_states = self.v_proj(hidden_states)
-
-        if self.peft_config.peft_mode == peft.PEFT_LORA:
-            query_states = self.peft_q_proj_lora(query_states)
-            value_states = self.peft_v_proj_lora(value_states)
-        if self.peft_config.peft_mode == peft.PEFT_IA3:
-            key_states, value_states = self.peft_ia3(key_states, value_states)
-        if self.peft_config.peft_mode == peft.PEFT_BITFIT:
-            query_states = self.peft_q_proj_bias(query_states)
-            key_states = self.peft_k_proj_bias(key_states)
-            value_states = self.peft_v_proj_bias(value_states)
+        # (batch_size, q_seq_len, hidden_dim) each
+        # q/k/v_proj are fused into a single matmul. PEFT methods are applied to each of the projected states.
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).chunk(3, dim=-1)
+        _, attn_output, kv_cache = self._attend(
+            query_states, key_states, value_states,
+            attention_mask=attention_mask, cos=cos, sin=sin, kv_cache=kv_cache,
+        )
+        return self._make_output(self.o_proj(self._merge_heads(attn_output)), kv_cache=kv_cache)
+
+    def _forward_lora(self, hidden_states, attention_mask, cos, sin, kv_cache=None):
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).chunk(3, dim=-1)
+        query_states = self.peft_q_proj_lora(query_states)
+        value_states = self.peft_v_proj_lora(value_states)
+        _, attn_output, kv_cache = self._attend(
+            query_states, key_states, value_states,
+            attention_mask=attention_mask, cos=cos, sin=sin, kv_cache=kv_cache,
+        )
+        return self._make_output(self.o_proj(self._merge_heads(attn_output)), kv_cache=kv_cache)
+
+    def _forward_ia3(self, hidden_states, attention_mask, cos, sin, kv_cache=None):
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).chunk(3, dim=-1)
+        key_states, value_states = self.peft_ia3(key_states, value_states)
+        _, attn_output, kv_cache = self._attend(
+            query_states, key_states, value_states,
+            attention_mask=attention_mask, cos=cos, sin=sin, kv_cache=kv_cache,
+        )
+        return self._make_output(self.o_proj(self._merge_heads(attn_output)), kv_cache=kv_cache)
+
+    def _forward_bitfit(self, hidden_states, attention_mask, cos, sin, kv_cache=None):
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).chunk(3, dim=-1)
+        query_states = self.peft_q_proj_bias(query_states)
+        key_states = self.peft_k_proj_bias(key_states)
+        value_states = self.peft_v_proj_bias(value_states)
+        _, attn_output, kv_cache = self._attend(
+            query_states, key_states, value_states,
+            attention_mask=attention_mask, cos=cos, sin=sin, kv_cache=kv_cache,
+        )
+        attn_output = self.peft_o_proj_bias(self.o_proj(self._merge_heads(attn_output)))
+        return self._make_output(attn_output, kv_cache=kv_cache)
+
+    def _forward_prefix_adapter(self, hidden_states, attention_mask, cos, sin, kv_cache=None):
+        query_states, key_states, value_states = self.qkv_proj(hidden_states).chunk(3, dim=-1)
+        query_states, attn_output, kv_cache = self._attend(
+            query_states, key_states, value_states,
+            attention_mask=attention_mask, cos=cos, sin=sin, kv_cache=kv_cache,
+        )
+        attn_output = attn_output + self.peft_prefix_adapter(query_states=query_states)
+        return self._make_output(self.o_proj(self._merge_heads(attn_output)), kv_cache=kv_cache)
 
+    def _attend(self, query_states, key_states, value_states, attention_mask, cos, sin, kv_cache):
+        """
+        :param query_states: (batch_size, q_seq_len, hidden_dim), as are key_states and value_states
+        :return: query_states and attn_output as (batch_size, num_heads, q_seq_len, head_dim), and kv_cache
+        """
+        batch_size, q_seq_len, hidden_dim = query_states.size()
         query_states = query_states.view(
             batch_size, q_seq_len, self.n_heads, self.head_dim).transpose(1, 2)
         key_states = key_states.view(
@@ -549,41 +954,50 @@ class Attention(nn.Module):
             batch_size, q_seq_len, self.n_heads, self.head_dim).transpose(1, 2)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos=cos, sin=sin)
 
-        if kv_cache:
+        if kv_cache and ("length" in kv_cache or "position" in kv_cache):
+            # Preallocated cache for generation, see: LLaMAModel.init_kv_cache
+            kv_cache = append_to_kv_cache(kv_cache, key_states=key_states, value_states=value_states)
+            key_states, value_states = read_kv_cache(kv_cache, dtype=query_states.dtype)
+        elif kv_cache:
+            # Fixed prefixes (prefix tuning, full forward pass)
             key_states = torch.cat([kv_cache["key"], key_states], dim=2)
             value_states = torch.cat([kv_cache["value"], value_states], dim=2)
+            kv_cache = {"key": key_states, "value": value_states}
 
         attn_output = torch.nn.functional.scaled_dot_product_attention(
             query=query_states,
             key=key_states,
             value=value_states,
             attn_mask=attention_mask,
+            is_causal=attention_mask is None,
         )
+        return query_states, attn_output, kv_cache
 
-        if self.peft_config.peft_mode == peft.PEFT_PREFIX_ADAPTER:
-            attn_output = attn_output + self.peft_prefix_adapter(query_states=query_states)
-
+    @staticmethod
+    def _merge_heads(attn_output):
+        batch_size, num_heads, q_seq_len, head_dim = attn_output.size()
         # (batch_size, q_seq_len, hidden_dim)
-        attn_output = attn_output.transpose(1, 2).contiguous().view(
-            batch_size, q_seq_len, hidden_dim,
+        # SDPA kernels generally return an output laid out as (batch_size, q_seq_len, num_heads, head_dim),
+        # in which case reshape is a view instead of a copy
+        return attn_output.transpose(1, 2).reshape(
+            batch_size, q_seq_len, num_heads * head_dim,
         )
-        attn_output = self.o_proj(attn_output)
-        if self.peft_config.peft_mode == peft.PEFT_BITFIT:
-            attn_output = self.peft_o_proj_bias(attn_output)
 
+    @staticmethod
+    def _make_output(attn_output, kv_cache):
         check_nan(attn_output)
         if kv_cache:
-            new_kv_cache = {"key": key_states, "value": value_states}
-            return {"attn_output": attn_output, "kv_cache": new_kv_cache}
+            return {"attn_output": attn_output, "kv_cache": kv_cache}
 
         return {"attn_output": attn_output}
 
 
 class RotaryEmbedding(torch.nn.Module):
-    def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
+    def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None, dtype=torch.float16):
         super().__init__()
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device=device) / dim))
-        self.register_buffer("inv_freq", inv_freq)
+        # Recomputed here, so not expected in the checkpoint (which transformers>=4.31 no longer saves it to)
+        self.register_buffer("inv_freq", inv_freq, persistent=False)
 
         # Build here to make `torch.jit.trace` work.
         self.max_seq_len_cached = max_position_embeddings
@@ -591,8 +1005,9 @@ class RotaryEmbedding(torch.nn.Module):
         freqs = torch.einsum("i,j->ij", t, self.inv_freq)
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.cos_cached = emb.cos()[None, None, :, :]
-        self.sin_cached = emb.sin()[None, None, :, :]
+        # Stored in the model dtype, so looking up cos/sin does not need a cast
+        self.register_buffer("cos_cached", emb.cos()[None, None, :, :].to(dtype), persistent=False)
+        self.register_buffer("sin_cached", emb.sin()[None, None, :, :].to(dtype), persistent=False)
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
@@ -611,22 +1026,31 @@ class RotaryEmbedding(torch.nn.Module):
         )
 
 
-def rotate_half(x):
-    """Rotates half the hidden dims of the input."""
+def rotate(x, cos, sin):
+    """Apply RoPE to x, given the first half of cos/sin.
+
+    Equivalent to (x * cos) + (rotate_half(x) * sin), without materializing rotate_half(x)
+    or the full-width products.
+    """
     x1 = x[..., : x.shape[-1] // 2]
     x2 = x[..., x.shape[-1] // 2:]
-    return torch.cat((-x2, x1), dim=-1)
+    return torch.cat((
+        torch.addcmul(x1 * cos, x2, sin, value=-1),
+        torch.addcmul(x2 * cos, x1, sin),
+    ), dim=-1)
 
 
 def apply_rotary_pos_emb(q, k, cos, sin):
-    q_embed = (q * cos) + (rotate_half(q) * sin)
-    k_embed = (k * cos) + (rotate_half(k) * sin)
-    return q_embed, k_embed
+    # Both halves of cos/sin hold the same frequencies (see: RotaryEmbedding), so only the first is needed
+    half_dim = cos.shape[-1] // 2
+    cos, sin = cos[..., :half_dim], sin[..., :half_dim]
+    return rotate(q, cos=cos, sin=sin), rotate(k, cos=cos, sin=sin)
 
 
 def create_attention_mask(input_ids,
                           dtype=torch.float32,
-                          return_soft_mask=True):
+                          return_soft_mask=True,
+                          pad_token_id=None):
     """Create mask for decoder attention.
 
     Decoder masks have two use-cases:
@@ -645,15 +1069,18 @@ def create_attention_mask(input_ids,
     :param input_ids: [batch_size, seq_len]
     :param dtype: dtype
     :param return_soft_mask: whether to return mask or logits-mask
-    :return: float [batch_size=1, num_heads=1, q_len=seq_len, kv_len=seq_len]
+    :param pad_token_id: if given, padding tokens are also masked out as keys
+    :return: float [batch_size=1 (batch_size with pad_token_id), num_heads=1, q_len=seq_len, kv_len=seq_len]
     """
     batch_size, seq_length = input_ids.shape
-    # [seq_len]
-    seq_ids = torch.arange(seq_length, device=input_ids.device)
-    # [seq_len, seq_len]
-    causal_mask = seq_ids[None, :].repeat(seq_length, 1) <= seq_ids[:, None]
+    if pad_token_id is None and return_soft_mask:
+        # [batch_size=1, num_heads=1, seq_len, seq_len]
+        return create_casual_soft_attention_mask(seq_length, dtype=dtype, device=input_ids.device)
     # [batch_size=1, num_heads=1, seq_len, seq_len]
-    causal_mask = causal_mask[None, None, :, :]
+    causal_mask = create_casual_attention_mask(seq_length, device=input_ids.device)
+    if pad_token_id is not None:
+        # [batch_size, num_heads=1, seq_len, seq_len]
+        causal_mask = causal_mask & (input_ids != pad_token_id)[:, None, None, :]
     if return_soft_mask:
         return convert_mask_to_soft_mask(causal_mask, dtype=dtype)
     else:
@@ -665,9 +1092,10 @@ def convert_mask_to_soft_mask(mask, dtype):
 
     (i.e. 0 for attention, large negative for masked)
     """
-    mask = mask.to(dtype=dtype)
-    mask = (1.0 - mask) * torch.finfo(dtype).min
-    return mask
+    # Fill directly in the target dtype, rather than casting the mask and rescaling it
+    return torch.full(
+        mask.shape, fill_value=torch.finfo(dtype).min, dtype=dtype, device=mask.device,
+    ).masked_fill_(mask, 0)
 
 
 class NoInitLinear(nn.Linear):
@@ -680,11 +1108,68 @@ class NoInit8bitLinear(bnb.nn.Linear8bitLt):
         pass
 
 
-def get_linear_class(use_8bit=False):
-    if use_8bit:
-        return NoInit8bitLinear
+class NoInit4bitLinear(bnb.nn.Linear4bit):
+    def reset_parameters(self) -> None:
+        pass
+
+
+def create_linear(config: LLaMAConfig, in_features, out_features):
+    """Create a (bias-free) projection of the base model."""
+    if config.use_4bit:
+        # NF4 weights, with matmuls in config.dtype
+        return NoInit4bitLinear(in_features, out_features, bias=False, compute_dtype=config.dtype, quant_type="nf4")
+    if config.use_8bit:
+        return NoInit8bitLinear(in_features, out_features, bias=False, threshold=6.0, has_fp16_weights=False)
+    return NoInitLinear(in_features, out_features, bias=False, dtype=config.dtype)
+
+
+QUANT_BACKEND_BNB = "bnb"
+QUANT_BACKEND_GEMLITE = "gemlite"
+QUANT_BACKEND_TORCH_CPU = "torch_cpu"
+
+
+def quantize_linear_layers_for_inference(model, device, quant_backend=QUANT_BACKEND_GEMLITE):
+    """Replace the projections of every layer with int8 (weight) layers, for inference only.
+
+    bitsandbytes' Linear8bitLt is built for training, and is slower than fp16 for small-batch decoding,
+    whereas GemLite's kernels are built for it. On CPU, PyTorch's dynamically quantized Linear (fbgemm/qnnpack)
+    is used instead. The PEFT methods only touch the projection outputs, and are kept as they are.
+    """
+    for layer in model.model.layers:
+        quantize_layer_for_inference(layer, device=device, quant_backend=quant_backend)
+
+
+def quantize_layer_for_inference(layer, device, quant_backend=QUANT_BACKEND_GEMLITE):
+    """Replace the projections of one layer. See: quantize_linear_layers_for_inference"""
+    if quant_backend == QUANT_BACKEND_GEMLITE:
+        from gemlite.helper import A16W8
+        quantize = A16W8(device=device).from_linear
+    elif quant_backend == QUANT_BACKEND_TORCH_CPU:
+        quantize = quantize_linear_for_cpu
     else:
-        return NoInitLinear
+        raise KeyError(quant_backend)
+    for module, name in [
+        (layer.self_attn, "qkv_proj"),
+        (layer.self_attn, "o_proj"),
+        (layer.mlp, "gate_up_proj"),
+        (layer.mlp, "down_proj"),
+    ]:
+        setattr(module, name, quantize(getattr(module, name)))
+
+
+def quantize_linear_for_cpu(linear):
+    """Convert a Linear to a dynamically quantized Linear (int8 weights, per output channel).
+
+    torch.ao's quantize_dynamic only converts modules of type nn.Linear exactly (not NoInitLinear),
+    so the weight is quantized here. Inputs are quantized per batch at runtime, and must be float32.
+    """
+    weight = linear.weight.detach().float()
+    scales = (weight.abs().amax(dim=1) / 127).clamp(min=1e-8).double()
+    zero_points = torch.zeros(scales.shape, dtype=torch.long)
+    qweight = torch.quantize_per_channel(weight, scales, zero_points, axis=0, dtype=torch.qint8)
+    qlinear = torch.ao.nn.quantized.dynamic.Linear(linear.in_features, linear.out_features, bias_=False)
+    qlinear.set_weight_bias(qweight, None)
+    return qlinear
 
 
 class NoInitEmbedding(nn.Embedding):
@@ -692,14 +1177,78 @@ class NoInitEmbedding(nn.Embedding):
         pass
 
 
+# Checking for NaNs syncs with the device on every call, so it is only done when debugging
+CHECK_NAN = os.environ.get("PEFTY_CHECK_NAN", "0") == "1"
+
+
 def check_nan(x):
-    if torch.isnan(x).any():
+    if CHECK_NAN and torch.isnan(x).any():
         import pdb
         pdb.set_trace()
 
 
-def create_model(model_name, hf_path, peft_config: peft.PeftConfig, use_8bit=False, device=None):
+# Checkpoint weights that are concatenated (along the output dim) into the weight of one fused projection
+FUSED_WEIGHTS = {
+    "self_attn.qkv_proj.weight": ("self_attn.q_proj.weight", "self_attn.k_proj.weight", "self_attn.v_proj.weight"),
+    "mlp.gate_up_proj.weight": ("mlp.gate_proj.weight", "mlp.up_proj.weight"),
+}
+
+
+def fuse_checkpoint_weights(loaded, pending, pin_memory=False):
+    """Concatenate per-projection checkpoint weights into the weights of fused projections.
+
+    The parts of a fused weight can be split across checkpoint shards, so they are held in
+    `pending` until all of them have been loaded.
+
+    :param loaded: state dict of one checkpoint shard
+    :param pending: dict(fused weight name -> dict(part suffix -> tensor)), carried across shards
+    :param pin_memory: concatenate the fused weights into page-locked memory
+    :return: state dict with fused weights for the completed fused projections
+    """
+    fused_loaded = {}
+    for k, v in loaded.items():
+        for fused_suffix, part_suffixes in FUSED_WEIGHTS.items():
+            part_suffix = next((suffix for suffix in part_suffixes if k.endswith(suffix)), None)
+            if part_suffix is None:
+                continue
+            fused_k = k[:-len(part_suffix)] + fused_suffix
+            parts = pending.setdefault(fused_k, {})
+            parts[part_suffix] = v
+            if len(parts) == len(part_suffixes):
+                fused_parts = [parts[suffix] for suffix in part_suffixes]
+                fused = torch.empty(
+                    [sum(part.shape[0] for part in fused_parts), *fused_parts[0].shape[1:]],
+                    dtype=fused_parts[0].dtype, pin_memory=pin_memory,
+                )
+                fused_loaded[fused_k] = torch.cat(fused_parts, dim=0, out=fused)
+                del pending[fused_k]
+            break
+        else:
+            fused_loaded[k] = v
+    return fused_loaded
+
+
+def create_model(model_name, hf_path, peft_config: peft.PeftConfig, use_8bit=False, device=None,
+                 fold_norm_weights=False, quant_backend=QUANT_BACKEND_BNB, use_4bit=False):
+    """
+    :param use_8bit: load the projections in 8-bit
+    :param use_4bit: load the projections in 4-bit (NF4, bitsandbytes), which is smaller and faster for
+        inference than bitsandbytes 8-bit
+    :param fold_norm_weights: See: LLaMAModel.fold_norm_weights
+    :param quant_backend: for 8-bit, "bnb" (bitsandbytes, supports training),
+        "gemlite" (faster, for inference only), or "torch_cpu" (for inference on CPU, in float32)
+    """
+    assert not (use_8bit and use_4bit)
+    if quant_backend not in (QUANT_BACKEND_BNB, QUANT_BACKEND_GEMLITE, QUANT_BACKEND_TORCH_CPU):
+        raise KeyError(quant_backend)
     config = LLAMA_CONFIG_DICT[model_name]
+    if use_8bit and quant_backend == QUANT_BACKEND_TORCH_CPU:
+        if device is None:
+            device = torch.device("cpu")
+        elif torch.device(device).type != "cpu":
+            raise ValueError(f"quant_backend={quant_backend!r} runs on CPU, but device={device} was given")
+        # The quantized CPU kernels take float32 activations (and CPU fp16 matmuls are slow anyway)
+        config = dataclasses.replace(config, dtype=torch.float32)
 
     with open(os.path.join(hf_path, "pytorch_model.bin.index.json")) as f:
         weight_map = json.load(f)["weight_map"]
@@ -708,81 +1257,237 @@ def create_model(model_name, hf_path, peft_config: peft.PeftConfig, use_8bit=Fal
     if device is None:
         # TODO: Local rank
         device = torch.device("cuda:0")
-    if use_8bit:
-        config = dataclasses.replace(config, use_8bit=True)
+    # GemLite and torch_cpu layers are created from unquantized ones, so each layer is loaded unquantized,
+    # and quantized as soon as all of its weights are loaded. Only the layers of the shards being loaded are
+    # held unquantized, rather than the whole model.
+    quantize_while_loading = use_8bit and quant_backend in (QUANT_BACKEND_GEMLITE, QUANT_BACKEND_TORCH_CPU)
+    if use_4bit or use_8bit:
+        if use_4bit:
+            config = dataclasses.replace(config, use_4bit=True)
+            set_tensor = set_module_4bit_tensor_to_device
+        elif quant_backend == QUANT_BACKEND_BNB:
+            config = dataclasses.replace(config, use_8bit=True)
+            set_tensor = set_module_8bit_tensor_to_device
+        else:
+            set_tensor = functools.partial(set_module_tensor_to_device, dtype=config.dtype)
         with init_empty_weights():
             model = LLaMAModel(config=config, peft_config=peft_config)
-        state_keys = set(model.state_dict())
-        filename_list = sorted(list(set(weight_map.values())))
-        for filename in tqdm.tqdm(filename_list):
-            loaded = torch.load(os.path.join(hf_path, filename), map_location="cpu")
+        # PEFT parameters are initialized by their modules, rather than loaded (see: materialize_peft_modules)
+        state_keys = {k for k in model.state_dict() if "peft_" not in k}
+        unquantized_layer_ids = set(range(config.n_layers)) if quantize_while_loading else set()
+        for loaded in load_checkpoint_shards(hf_path, filename_list, device=device):
             for k, v in loaded.items():
-                set_module_8bit_tensor_to_device(model, tensor_name=k, device=device, value=v)
-                state_keys.remove(k)
+                set_tensor(model, tensor_name=k, device=device, value=v)
+            state_keys.difference_update(loaded)
+            # Release the shard (see: load_checkpoint_shards)
+            del loaded
+            for layer_i in sorted(unquantized_layer_ids):
+                prefix = f"model.layers.{layer_i}."
+                if any(k.startswith(prefix) for k in state_keys):
+                    continue
+                layer = model.model.layers[layer_i]
+                if fold_norm_weights:
+                    # Before quantizing, which would leave no weights to rescale
+                    layer.fold_norm_weights()
+                quantize_layer_for_inference(layer, device=device, quant_backend=quant_backend)
+                unquantized_layer_ids.remove(layer_i)
         assert not state_keys
+        # init_empty_weights only puts parameters on the meta device, and buffers stay on the CPU. The
+        # non-persistent ones (the RoPE tables) are not in the checkpoint, so they are moved here.
+        for module in model.modules():
+            for name in module._non_persistent_buffers_set:
+                module._buffers[name] = module._buffers[name].to(device)
+        materialize_peft_modules(model, device=device)
     else:
-        # noinspection PyUnresolvedReferences
-        torch.set_default_tensor_type(torch.cuda.HalfTensor)
-        model = LLaMAModel(config=config, peft_config=peft_config).cuda()
-        torch.set_default_tensor_type(torch.FloatTensor)
-        state_keys = set(model.state_dict())
-        for filename in tqdm.tqdm(filename_list):
-            loaded = torch.load(os.path.join(hf_path, filename), map_location="cpu")
+        # Every module gets its dtype from the config, so only the device needs to be set
+        with torch.device(device):
+            model = LLaMAModel(config=config, peft_config=peft_config)
+        # PEFT parameters are initialized by their modules, rather than loaded
+        state_keys = {k for k in model.state_dict() if "peft_" not in k}
+        for loaded in load_checkpoint_shards(hf_path, filename_list, device=device):
             model.load_state_dict(loaded, strict=False)
-            for k in loaded:
-                state_keys.remove(k)
+            state_keys.difference_update(loaded)
+            del loaded
+        # Otherwise, the missing weights would be left as uninitialized memory (see: NoInitLinear)
+        assert not state_keys
+    if fold_norm_weights:
+        model.fold_norm_weights()
     return model
 
 
-def shift_kv_cache_right(layer_cache, num_valid_tokens):
+def load_checkpoint_shards(hf_path, filename_list, device):
+    """Yield the state dict of each checkpoint shard, with fused weights (see: fuse_checkpoint_weights),
+    reading the next shard from disk in the background.
+
+    Shards are memory-mapped, so reading them from disk happens when their tensors are first used. The
+    background thread does this reading, by fusing the weights and, for CUDA, copying the tensors into
+    page-locked memory (which also makes the copies to the device faster), while the current shard is copied
+    to the device. The shard being read and the current shard are held in host memory, as well as the parts
+    of fused weights that are split across shards. For CUDA, page-locked memory comes from PyTorch's caching
+    host allocator, which rounds each tensor up to a power of two, and does not return freed blocks to the
+    OS by itself, so its cache is emptied when loading is done.
+
+    The caller should drop its references to each shard before getting the next one, so that it is released
+    before the shard after it is read.
     """
-    :param layer_cache: left-aligned kv cache element, [batch_size, num_heads, seq_len, dim]
-    :param num_valid_tokens: [batch_size]
-    :return:
+    pin_memory = torch.device(device).type == "cuda"
+    pending = {}
+
+    def load(filename):
+        loaded = torch.load(os.path.join(hf_path, filename), map_location="cpu", mmap=True, weights_only=True)
+        loaded = fuse_checkpoint_weights(loaded, pending=pending, pin_memory=pin_memory)
+        if pin_memory:
+            # Fused weights are already concatenated into page-locked memory
+            loaded = {k: v if v.is_pinned() else v.pin_memory() for k, v in loaded.items()}
+        return loaded
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(load, filename_list[0])
+            # The progress bar iterates over the file names: wrapping this generator instead would keep a
+            # reference to the previous shard while the next one is read
+            for next_filename in tqdm.tqdm(filename_list[1:] + [None]):
+                shard = [future.result()]
+                future = executor.submit(load, next_filename) if next_filename is not None else None
+                # Popped, so that only the caller holds the shard, and it is released once the caller drops it
+                yield shard.pop()
+                gc.collect()
+        assert not pending
+    finally:
+        if pin_memory:
+            # Drop the shard read ahead (if stopped early), so that its blocks are freed
+            future = None
+            gc.collect()
+            torch._C._host_emptyCache()
+
+
+def materialize_peft_modules(model, device):
+    """Initialize the PEFT modules of a model built under init_empty_weights, on device.
+
+    init_empty_weights leaves every parameter on the meta device, including those of the PEFT modules,
+    which are not in the checkpoint. These are allocated on device, and initialized with reset_parameters.
     """
-    batch_size = layer_cache.shape[0]
-    # noinspection PyUnresolvedReferences
-    return torch.stack([
-        torch.cat([
-            layer_cache[i, :, num_valid_tokens[i]:, :],
-            layer_cache[i, :, :num_valid_tokens[i], :],
-        ], dim=1)
-        for i in range(batch_size)
-    ], dim=0)
-
-
-def create_generation_attention_mask(batch_size, seq_len, num_valid_tokens, device):
+    for name, module in model.named_modules():
+        if name.rpartition(".")[2].startswith("peft_"):
+            module.to_empty(device=device)
+            module.reset_parameters()
+
+
+def set_module_4bit_tensor_to_device(module, tensor_name, device, value):
+    """Like set_module_8bit_tensor_to_device, but quantizes the weights of 4-bit layers to NF4."""
+    module_name, _, param_name = tensor_name.rpartition(".")
+    submodule = module.get_submodule(module_name)
+    if isinstance(submodule, bnb.nn.Linear4bit) and param_name == "weight":
+        # Quantized when moved to the device
+        submodule.weight = bnb.nn.Params4bit(
+            value, requires_grad=False, quant_type=submodule.weight.quant_type,
+        ).to(device)
+    else:
+        set_module_8bit_tensor_to_device(module, tensor_name=tensor_name, device=device, value=value)
+
+
+def append_to_kv_cache(kv_cache, key_states, value_states):
+    """Write new key/value states into a preallocated KV cache (see: LLaMAModel.init_kv_cache)
+
+    With static shapes (see: LLaMAModel.generate), the cache holds a position tensor instead of a length,
+    which the caller advances.
+
+    :param kv_cache: dict(key, value, length), or dict(key, value, position=[1])
+    :param key_states: [batch_size, num_heads, q_seq_len, head_dim]
+    :param value_states: [batch_size, num_heads, q_seq_len, head_dim]
+    :return: kv_cache with the updated length. The key/value buffers are written in place.
     """
-    :param batch_size: int
-    :param seq_len: int
-    :param num_valid_tokens: [batch_size]
-    :param device:
-    :return:
+    if "position" in kv_cache:
+        # [q_seq_len]
+        positions = kv_cache["position"] + torch.arange(key_states.shape[2], device=key_states.device)
+        if "key_scale" in kv_cache:
+            key_states, key_scale = quantize_per_token(key_states)
+            value_states, value_scale = quantize_per_token(value_states)
+            kv_cache["key_scale"].index_copy_(2, positions, key_scale)
+            kv_cache["value_scale"].index_copy_(2, positions, value_scale)
+        kv_cache["key"].index_copy_(2, positions, key_states)
+        kv_cache["value"].index_copy_(2, positions, value_states)
+        return kv_cache
+
+    start = kv_cache["length"]
+    end = start + key_states.shape[2]
+    if "key_scale" in kv_cache:
+        key_states, kv_cache["key_scale"][:, :, start:end] = quantize_per_token(key_states)
+        value_states, kv_cache["value_scale"][:, :, start:end] = quantize_per_token(value_states)
+    kv_cache["key"][:, :, start:end] = key_states
+    kv_cache["value"][:, :, start:end] = value_states
+    return {**kv_cache, "length": end}
+
+
+def read_kv_cache(kv_cache, dtype):
+    """Get the filled part of a preallocated KV cache, dequantized if needed.
+
+    Dequantizing makes a copy of the filled part in dtype, which attention then reads.
+
+    :param kv_cache: dict(key, value, length), and key_scale, value_scale if quantized
+    :param dtype: dtype to dequantize to
+    :return: key, value [batch_size, num_heads, length, head_dim]. With static shapes, the whole buffers.
+    """
+    length = kv_cache.get("length")
+    key, value = kv_cache["key"][:, :, :length], kv_cache["value"][:, :, :length]
+    if "key_scale" in kv_cache:
+        key = key.to(dtype) * kv_cache["key_scale"][:, :, :length]
+        value = value.to(dtype) * kv_cache["value_scale"][:, :, :length]
+    return key, value
+
+
+def quantize_per_token(x):
+    """Symmetric int8 quantization, with one scale per token (and head).
+
+    :param x: [..., head_dim]
+    :return: int8 x, scale [..., 1], such that x ~= x_int8 * scale
     """
-    # For right-aligned, based on num_valid_tokens
-    # noinspection PyTypeChecker
-    attn_mask = torch.zeros([batch_size, 1, 1, seq_len], dtype=bool)
-    for i in range(batch_size):
-        valid = num_valid_tokens[i]
-        # noinspection PyTypeChecker
-        # attn_mask[i, 0, -valid:, -valid:] = torch.tril(torch.ones([valid, valid], dtype=bool))
-        attn_mask[i, 0, 0, -valid:] = True
-    return attn_mask.to(device=device)
+    scale = (x.abs().amax(dim=-1, keepdim=True) / 127).clamp(min=torch.finfo(x.dtype).tiny)
+    return torch.round(x / scale).to(torch.int8), scale
 
 
 def create_casual_attention_mask(seq_len, device):
-    # noinspection PyTypeChecker
-    attn_mask = torch.tril(torch.ones([seq_len, seq_len], dtype=bool))[None, None, :, :]
-    return attn_mask.to(device=device)
+    """Causal mask, built once per (seq_len, device). The returned tensor is shared, so do not modify it.
+
+    :return: [batch_size=1, num_heads=1, seq_len, seq_len]
+    """
+    return _create_casual_attention_mask(seq_len, _mask_cache_device_key(device))
+
+
+def create_casual_soft_attention_mask(seq_len, dtype, device):
+    """Causal mask that can be added to logits (see: convert_mask_to_soft_mask), built once per
+    (seq_len, dtype, device). The returned tensor is shared, so do not modify it.
+
+    :return: [batch_size=1, num_heads=1, seq_len, seq_len]
+    """
+    return _create_casual_soft_attention_mask(seq_len, dtype, _mask_cache_device_key(device))
+
+
+def _mask_cache_device_key(device):
+    # So that "cuda" and "cuda:0" share cache entries
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return str(device)
+
+
+# The cached masks live for the whole process (a soft mask for 2048 tokens in fp16 is 8 MB), so only
+# a few are kept. They are built outside of inference mode, so that they can also be used in training.
+@functools.lru_cache(maxsize=4)
+@torch.inference_mode(False)
+def _create_casual_attention_mask(seq_len, device):
+    seq_ids = torch.arange(seq_len, device=device)
+    return (seq_ids[:, None] >= seq_ids[None, :])[None, None, :, :]
+
+
+@functools.lru_cache(maxsize=4)
+@torch.inference_mode(False)
+def _create_casual_soft_attention_mask(seq_len, dtype, device):
+    return convert_mask_to_soft_mask(_create_casual_attention_mask(seq_len, device), dtype=dtype)
 
 
 def create_rope_embed_ids(input_ids):
     pad_token_id = 0
     max_position = 2047  # These will not actually be used, as they are masked out by the attention mask
-    x = (input_ids != pad_token_id).cumsum(-1) - 1
-    x[input_ids == pad_token_id] = max_position
-    return x
-
-
-def zeros_like(shape, tensor):
-    return torch.zeros(shape).type_as(tensor).to(tensor.device)
+    is_valid = input_ids != pad_token_id
+    return torch.where(is_valid, is_valid.cumsum(-1) - 1, max_position)
@@ -7,8 +7,12 @@ from .configuration import PeftConfig
 class Adapter(nn.Module):
     def __init__(self, config: LLaMAConfig, peft_config: PeftConfig):
         super().__init__()
-        self.down_proj = nn.Linear(config.dim, peft_config.adapter_hidden_size, bias=False)
-        self.up_proj = nn.Linear(peft_config.adapter_hidden_size, config.dim, bias=False)
+        self.down_proj = nn.Linear(config.dim, peft_config.adapter_hidden_size, bias=False, dtype=config.dtype)
+        self.up_proj = nn.Linear(peft_config.adapter_hidden_size, config.dim, bias=False, dtype=config.dtype)
+
+    def reset_parameters(self):
+        self.down_proj.reset_parameters()
+        self.up_proj.reset_parameters()
 
     def forward(self, hidden_states):
         return self.up_proj(F.gelu(self.down_proj(hidden_states))) + hidden_states
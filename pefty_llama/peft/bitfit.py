@@ -5,7 +5,11 @@ import torch.nn as nn
 class BitFitAddBias(nn.Module):
     def __init__(self, dim: int, dtype=torch.float16):
         super().__init__()
-        self.bias = nn.Parameter(torch.zeros(dim, dtype=dtype))
+        self.bias = nn.Parameter(torch.empty(dim, dtype=dtype))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.zeros_(self.bias)
 
     def forward(self, hidden_state):
         return hidden_state + self.bias
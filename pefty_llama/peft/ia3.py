@@ -159,8 +159,13 @@ class IA3ForAttn(nn.Module):
         self.n_heads = config.n_heads
         self.head_dim = config.dim // config.n_heads
 
-        self.peft_l_k = nn.Parameter(torch.ones(config.dim, dtype=config.dtype))
-        self.peft_l_v = nn.Parameter(torch.ones(config.dim, dtype=config.dtype))
+        self.peft_l_k = nn.Parameter(torch.empty(config.dim, dtype=config.dtype))
+        self.peft_l_v = nn.Parameter(torch.empty(config.dim, dtype=config.dtype))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.ones_(self.peft_l_k)
+        nn.init.ones_(self.peft_l_v)
 
     def forward(self, key_states, value_states):
         return key_states * self.peft_l_k, value_states * self.peft_l_v
@@ -175,7 +180,11 @@ class IA3ForMLP(nn.Module):
         intermediate_dim = int(2 * intermediate_dim / 3)
         intermediate_dim = multiple_of * ((intermediate_dim + multiple_of - 1) // multiple_of)
 
-        self.peft_l_ffn = nn.Parameter(torch.ones(1, 1, intermediate_dim, dtype=config.dtype))
+        self.peft_l_ffn = nn.Parameter(torch.empty(1, 1, intermediate_dim, dtype=config.dtype))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.ones_(self.peft_l_ffn)
 
     def forward(self, intermediate_state):
         return self.peft_l_ffn * intermediate_state
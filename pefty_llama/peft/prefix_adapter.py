@@ -9,11 +9,17 @@ class PrefixAdapter(nn.Module):
     def __init__(self, config: LLaMAConfig, peft_config: PeftConfig):
         super().__init__()
         # "batch_size"=1, num_heads, num_prefix_tokens, head_dim
-        self.prefix_k = nn.Parameter(torch.randn(
+        self.prefix_k = nn.Parameter(torch.empty(
             1, config.n_heads, peft_config.num_prefix_tokens, config.head_dim, dtype=config.dtype))
-        self.prefix_v = nn.Parameter(torch.randn(
+        self.prefix_v = nn.Parameter(torch.empty(
             1, config.n_heads, peft_config.num_prefix_tokens, config.head_dim, dtype=config.dtype))
-        self.gate = nn.Parameter(torch.zeros(1, config.n_heads, 1, 1))
+        self.gate = nn.Parameter(torch.empty(1, config.n_heads, 1, 1, dtype=config.dtype))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.normal_(self.prefix_k)
+        nn.init.normal_(self.prefix_v)
+        nn.init.zeros_(self.gate)
 
     def forward(self, query_states):
         batch_size, num_heads, q_seq_len, head_dim = query_states.shape
@@ -15,17 +15,27 @@ class SoftPrefixes(nn.Module):
             else:
                 intermediate_size = self.config.dim
 
-            self.initial = nn.Parameter(torch.randn(peft_config.num_prefix_tokens, config.dim, dtype=config.dtype))
+            self.initial = nn.Parameter(torch.empty(peft_config.num_prefix_tokens, config.dim, dtype=config.dtype))
             self.mlp = torch.nn.Sequential(
-                torch.nn.Linear(config.dim, intermediate_size),
+                torch.nn.Linear(config.dim, intermediate_size, dtype=config.dtype),
                 torch.nn.Tanh(),
-                torch.nn.Linear(intermediate_size, config.n_layers * 2 * config.dim),
+                torch.nn.Linear(intermediate_size, config.n_layers * 2 * config.dim, dtype=config.dtype),
             )
         else:
-            self.soft_prompt = nn.Parameter(torch.randn(
+            self.soft_prompt = nn.Parameter(torch.empty(
                 peft_config.num_prefix_tokens, config.n_layers * 2 * config.dim,
                 dtype=config.dtype,
             ))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        if self.peft_config.prefix_use_mlp:
+            nn.init.normal_(self.initial)
+            for module in self.mlp:
+                if isinstance(module, nn.Linear):
+                    module.reset_parameters()
+        else:
+            nn.init.normal_(self.soft_prompt)
 
     def forward(self, batch_size):
         if self.peft_config.prefix_use_mlp:
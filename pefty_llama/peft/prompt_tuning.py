@@ -7,7 +7,11 @@ from .configuration import PeftConfig
 class AddSoftPrompt(nn.Module):
     def __init__(self, config: LLaMAConfig, peft_config: PeftConfig):
         super().__init__()
-        self.soft_prompt = nn.Parameter(torch.randn(peft_config.num_prefix_tokens, config.dim, dtype=config.dtype))
+        self.soft_prompt = nn.Parameter(torch.empty(peft_config.num_prefix_tokens, config.dim, dtype=config.dtype))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.normal_(self.soft_prompt)
 
     def forward(self, hidden_states):
         batch_size, seq_len, dim = hidden_states.shape